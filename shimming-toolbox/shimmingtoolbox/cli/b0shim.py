@@ -10,13 +10,22 @@ the gradient method in a st_shim CLI with the argument being:
 
 import click
 import copy
+import io
 import json
 import nibabel as nib
 import numpy as np
 import logging
 import os
+import shutil
+from joblib import delayed, Parallel
 from matplotlib.figure import Figure
 
+try:
+    # Faster json parser, optional
+    import orjson
+except ImportError:
+    orjson = None
+
 from shimmingtoolbox import __config_scanner_constraints__, __config_custom_coil_constraints__
 from shimmingtoolbox.cli.realtime_shim import gradient_realtime
 from shimmingtoolbox.coils.coil import Coil, ScannerCoil, get_scanner_constraints, restrict_sph_constraints
@@ -33,6 +42,8 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 AVAILABLE_ORDERS = [-1, 0, 1, 2, 3]
+# Maximum height of the current figures in inches, limits the size of the rendered image when there are many shim groups
+MAX_FIGURE_HEIGHT = 40
 
 
 @click.group(context_settings=CONTEXT_SETTINGS,
@@ -155,34 +166,6 @@ def dynamic(fname_fmap, fname_anat, fname_mask_anat, method, opt_criteria, slice
     # Parse scanner_coil_order
     scanner_coil_order = parse_orders(scanner_coil_order)
 
-    # Load the fieldmap
-    nii_fmap_orig = nib.load(fname_fmap)
-
-    # Make sure the fieldmap has the appropriate dimensions
-    if nii_fmap_orig.get_fdata().ndim != 3:
-        if nii_fmap_orig.get_fdata().ndim == 2:
-            nii_fmap = nib.Nifti1Image(nii_fmap_orig.get_fdata()[..., np.newaxis], nii_fmap_orig.affine,
-                                       header=nii_fmap_orig.header)
-            nii_fmap = extend_fmap_to_kernel_size(nii_fmap, dilation_kernel_size, path_output)
-        else:
-            raise ValueError("Fieldmap must be 2d or 3d")
-    else:
-        # Extend the fieldmap if there are axes that have less voxels than the kernel size. This is done since we are
-        # fitting a fieldmap to coil profiles and having a small number of voxels can lead to errors in fitting
-        # (2 voxels in one dimension can differentiate order 1 at most), the parameter allows to have at least the
-        # size of the kernel for each dimension This is usually useful in the through plane direction where we could
-        # have less slices. To mitigate this, we create a 3d volume by replicating the slices on the edges.
-        extending = False
-        for i_axis in range(3):
-            if nii_fmap_orig.shape[i_axis] < dilation_kernel_size:
-                extending = True
-                break
-
-        if extending:
-            nii_fmap = extend_fmap_to_kernel_size(nii_fmap_orig, dilation_kernel_size, path_output)
-        else:
-            nii_fmap = copy.deepcopy(nii_fmap_orig)
-
     # Prepare the output
     create_output_dir(path_output)
 
@@ -218,9 +201,8 @@ def dynamic(fname_fmap, fname_anat, fname_mask_anat, method, opt_criteria, slice
             raise RuntimeError("Slice encode direction must be the 3rd dimension of the NIfTI file.")
 
     # Load anat json
-    fname_anat_json = fname_anat.rsplit('.nii', 1)[0] + '.json'
-    with open(fname_anat_json) as json_file:
-        json_anat_data = json.load(json_file)
+    fname_anat_json = _get_fname_json(fname_anat)
+    json_anat_data = _read_json(fname_anat_json)
 
     # Get the EPI echo time if optimization criteria is grad
     if opt_criteria == 'grad':
@@ -228,27 +210,27 @@ def dynamic(fname_fmap, fname_anat, fname_mask_anat, method, opt_criteria, slice
     else:
         epi_te = None
 
+    # Open json of the fmap, check it exists before loading any data
+    fname_json = _get_fname_json(fname_fmap)
+    # Read from json file
+    if os.path.isfile(fname_json):
+        json_fm_data = _read_json(fname_json)
+    else:
+        raise OSError("Missing fieldmap json file")
+
     # Load mask
     if fname_mask_anat is not None:
         nii_mask_anat = nib.load(fname_mask_anat)
     else:
         # If no mask is provided, shim the whole anat volume
-        nii_mask_anat = nib.Nifti1Image(np.ones_like(nii_anat.get_fdata()), nii_anat.affine, header=nii_anat.header)
+        nii_mask_anat = nib.Nifti1Image(np.ones(nii_anat.shape, dtype=np.float32), nii_anat.affine,
+                                        header=nii_anat.header)
 
     if logger.level <= getattr(logging, 'DEBUG'):
         # Save inputs
         list_fname = [fname_fmap, fname_anat, fname_mask_anat]
         _save_nii_to_new_dir(list_fname, path_output)
 
-    # Open json of the fmap
-    fname_json = fname_fmap.rsplit('.nii', 1)[0] + '.json'
-    # Read from json file
-    if os.path.isfile(fname_json):
-        with open(fname_json) as json_file:
-            json_fm_data = json.load(json_file)
-    else:
-        raise OSError("Missing fieldmap json file")
-
     # Error out for unsupported inputs. If file format is in gradient CS, it must be 1st order and the output format be
     # delta. Only Siemens gradient coordinate system has been defined
     if o_format_sph == 'gradient':
@@ -262,6 +244,9 @@ def dynamic(fname_fmap, fname_anat, fname_mask_anat, method, opt_criteria, slice
             raise NotImplementedError(f"Unsupported manufacturer: {json_fm_data.get('Manufacturer')} for output file"
                                       f"format: {o_format_sph}")
 
+    # Load the fieldmap, all the inputs have been validated
+    nii_fmap_orig, nii_fmap = _load_fmap(fname_fmap, 3, dilation_kernel_size, path_output)
+
     # Read the current shim settings from the scanner
     scanner_shim_settings = ScannerShimSettings(json_fm_data, orders=scanner_coil_order)
     options = {'scanner_shim': scanner_shim_settings.shim_settings}
@@ -273,10 +258,12 @@ def dynamic(fname_fmap, fname_anat, fname_mask_anat, method, opt_criteria, slice
     # Get the shim slice ordering
     n_slices = nii_anat.shape[2]
     if slices == 'auto':
-        list_slices = parse_slices(fname_anat)
+        list_slices = parse_slices(fname_anat, json_anat_data)
     else:
         list_slices = define_slices(n_slices, slice_factor, slices, json_fm_data.get('SoftwareVersions'))
     logger.info(f"The slices to shim are:\n{list_slices}")
+    # Index of the shim group of each slice, shared by all the outputs
+    slice_to_shim = _get_slice_to_shim(list_slices)
     # Get shimming coefficients
     # 1 ) Create the Shimming sequencer object
     sequencer = ShimSequencer(nii_fmap_orig, json_fm_data,
@@ -299,62 +286,55 @@ def dynamic(fname_fmap, fname_anat, fname_mask_anat, method, opt_criteria, slice
     # Load output options
     options['fatsat'] = _get_fatsat_option(json_anat_data, fatsat)
 
-    list_fname_output = []
-    end_channel = 0
-    for i_coil, coil in enumerate(list_coils):
+    # Figure out the start and end channels of each coil to be able to select it from the coefs
+    end_channels = np.cumsum([coil.dim[3] for coil in list_coils])
+    start_channels = end_channels - [coil.dim[3] for coil in list_coils]
+    # Same for all the coils, decided once
+    manufacturer = json_anat_data.get('Manufacturer')
+    # Orders converted to the gradient CS, f0 is not converted
+    orders_gradient = tuple([order for order in scanner_coil_order if order != 0])
 
-        # Figure out the start and end channels for a coil to be able to select it from the coefs
+    def _output_coil(i_coil, coil):
+        """ Output the coefficients of a coil to text file(s), returns the list of files written """
         n_channels = coil.dim[3]
-        start_channel = end_channel
-        end_channel = start_channel + n_channels
 
         # Select the coefficients for a coil
-        coefs_coil = copy.deepcopy(coefs[:, start_channel:end_channel])
+        coefs_coil = coefs[:, start_channels[i_coil]:end_channels[i_coil]].copy()
 
         # If it's a scanner
         if type(coil) == ScannerCoil:
-            manufacturer = json_anat_data['Manufacturer']
-
             # If outputting in the gradient CS, it must be the 1st order, it must be in the delta CS and Siemens
             # The check has already been done earlier in the program to avoid processing and throw an error afterwards.
             # Therefore, we can only check for the o_format_sph.
             if o_format_sph == 'gradient':
                 logger.debug("Converting Siemens scanner coil from Shim CS (LAI) to Gradient CS")
-                # First convert to RAS
-                orders = tuple([order for order in scanner_coil_order if order != 0])
-                for i_shim in range(coefs.shape[0]):
-                    # Convert coefficient
-                    coefs_coil[i_shim, 1:] = shim_to_phys_cs(coefs_coil[i_shim, 1:], manufacturer, orders)
-
-                # Convert coef of 1st order sph harmonics to Gradient coord system
-                coefs_freq, coefs_phase, coefs_slice = phys_to_gradient_cs(coefs_coil[:, 1],
-                                                                           coefs_coil[:, 2],
-                                                                           coefs_coil[:, 3], fname_anat)
-
-                coefs_coil[:, 1] = coefs_freq
-                coefs_coil[:, 2] = coefs_phase
-                coefs_coil[:, 3] = coefs_slice
+                coefs_coil = _shim_to_gradient_cs(coefs_coil, manufacturer, orders_gradient, nii_anat,
+                                                  json_anat_data)
 
             else:
 
                 # If the output format is absolute, add the initial coefs
                 if output_value_format == 'absolute':
                     initial_coefs = scanner_shim_settings.concatenate_shim_settings(scanner_coil_order)
-                    for i_channel in range(n_channels):
-                        # abs_coef = delta + initial
-                        coefs_coil[:, i_channel] = coefs_coil[:, i_channel] + initial_coefs[i_channel]
+                    # abs_coef = delta + initial
+                    coefs_coil += initial_coefs[:n_channels]
 
-                    list_fname_output += _save_to_text_file_static(coil, coefs_coil, list_slices, path_output,
-                                                                   o_format_sph, options, coil_number=i_coil,
-                                                                   default_coefs=initial_coefs)
-                    continue
+                    return _save_to_text_file_static(coil, coefs_coil, list_slices, path_output, o_format_sph,
+                                                     options, coil_number=i_coil, default_coefs=initial_coefs,
+                                                     slice_to_shim=slice_to_shim)
 
-            list_fname_output += _save_to_text_file_static(coil, coefs_coil, list_slices, path_output, o_format_sph,
-                                                           options, coil_number=i_coil)
+            return _save_to_text_file_static(coil, coefs_coil, list_slices, path_output, o_format_sph, options,
+                                             coil_number=i_coil, slice_to_shim=slice_to_shim)
 
         else:
-            list_fname_output += _save_to_text_file_static(coil, coefs_coil, list_slices, path_output, o_format_coil,
-                                                           options, coil_number=i_coil)
+            return _save_to_text_file_static(coil, coefs_coil, list_slices, path_output, o_format_coil, options,
+                                             coil_number=i_coil, slice_to_shim=slice_to_shim)
+
+    # The coils are independent from each other, output them concurrently. Threads are used since the work is mostly
+    # I/O and numpy operations.
+    list_fname_coils = Parallel(-1, backend='threading')(
+        delayed(_output_coil)(i_coil, coil) for i_coil, coil in enumerate(list_coils))
+    list_fname_output = [fname for list_fname_coil in list_fname_coils for fname in list_fname_coil]
 
     logger.info(f"Coil txt file(s) are here:\n{os.linesep.join(list_fname_output)}")
     logger.info(f"Plotting figure(s)")
@@ -362,81 +342,64 @@ def dynamic(fname_fmap, fname_anat, fname_mask_anat, method, opt_criteria, slice
     logger.info(f" Plotting currents")
 
     if logger.level <= getattr(logging, 'DEBUG'):
-        # Plot the coefs after outputting the currents to the text file
-        end_channel = 0
-        for i_coil, coil in enumerate(list_coils):
-            # Figure out the start and end channels for a coil to be able to select it from the coefs
-            n_channels = coil.dim[3]
-            start_channel = end_channel
-            end_channel = start_channel + n_channels
-
-            if type(coil) != ScannerCoil:
-                # Select the coefficients for a coil
-                coefs_coil = copy.deepcopy(coefs[:, start_channel:end_channel])
-                # Plot a figure of the coefficients
-                _plot_coefs(coil, list_slices, coefs_coil, path_output, i_coil,
-                            bounds=[bound for bounds in coil.coef_channel_minmax.values() for bound in bounds])
+        # Plot the coefs after outputting the currents to the text file. Rendering is CPU bound, each coil is plotted
+        # in its own process.
+        Parallel(-1, backend='loky')(
+            delayed(_plot_coefs_worker)(verbose, coil.name, list_slices,
+                                        coefs[:, start_channels[i_coil]:end_channels[i_coil]], path_output, i_coil,
+                                        bounds=[bound for bounds in coil.coef_channel_minmax.values()
+                                                for bound in bounds])
+            for i_coil, coil in enumerate(list_coils) if type(coil) != ScannerCoil)
 
         logger.info(f"Finished plotting figure(s)")
 
 
 def _save_to_text_file_static(coil, coefs, list_slices, path_output, o_format, options, coil_number,
-                              default_coefs=None):
-    """o_format can either be 'slicewise-ch', 'slicewise-coil', 'chronological-ch', 'chronological-coil', 'gradient'"""
+                              default_coefs=None, slice_to_shim=None):
+    """o_format can either be 'slicewise-ch', 'slicewise-coil', 'chronological-ch', 'chronological-coil', 'gradient'.
+    slice_to_shim is the output of _get_slice_to_shim(list_slices), it is calculated if not provided."""
 
     logger.info(f"Saving to text file with format: {o_format}")
     n_channels = coil.dim[3]
+    if slice_to_shim is None:
+        # Index of the shim group of each slice
+        slice_to_shim = _get_slice_to_shim(list_slices)
     list_fname_output = []
     if o_format[-5:] == '-coil':
 
         fname_output = os.path.join(path_output, f"coefs_coil{coil_number}_{coil.name}.txt")
-        if options['fatsat']:
-            fname_output_no_fatsat = os.path.join(path_output, f"coefs_coil{coil_number}_{coil.name}_no_fatsat.txt")
-            f_no_fatsat = open(fname_output_no_fatsat, 'w', encoding='utf-8')
 
         # Print the average shim coefficients without considering slices with 0s
         logger.info(f"Average shim coefficients for coil {coil.name} without considering slices with 0s: "
                     f"{np.mean(np.sum(abs(coefs), axis=1, where=(coefs!=0)), axis=0)}")
 
+        # Each row contains all the channels separated by a comma, a trailing comma is kept at the end of the row
+        fmt_coil = ', '.join(['%.6f'] * n_channels) + ', '
+        # The content of each file is formatted in memory and written at once
+        if o_format == 'chronological-coil':
+            # Output per shim (chronological), output all channels for a particular shim, then repeat
+            rows = _format_rows(coefs[:len(list_slices)], fmt_coil)
+            if options['fatsat']:
+                # If fatsat pulse, add a row of shim coefs set to 0 (delta) or set to the initial coefs (absolute)
+                # before each shim
+                if default_coefs is None:
+                    row_fatsat = f"{0:.1f}, " * n_channels + "\n"
+                else:
+                    row_fatsat = _format_rows(np.asarray(default_coefs[:n_channels])[np.newaxis], fmt_coil)[0]
+                fname_output_no_fatsat = os.path.join(path_output,
+                                                      f"coefs_coil{coil_number}_{coil.name}_no_fatsat.txt")
+                with open(fname_output_no_fatsat, 'w', encoding='utf-8') as f:
+                    f.write(''.join(rows))
+                rows = [row_fatsat + row for row in rows]
+
+        else:  # o_format == 'slicewise-coil'
+            # Output per slice, output all channels for a particular slice, then repeat
+            # Assumes all slices are in list_slices once which is the case for ascending, descending, interleaved and
+            # volume
+            rows = _format_rows(coefs[slice_to_shim], fmt_coil)
+
         with open(fname_output, 'w', encoding='utf-8') as f:
-            # (len(slices) x n_channels)
-
-            if o_format == 'chronological-coil':
-                # Output per shim (chronological), output all channels for a particular shim, then repeat
-                for i_shim in range(len(list_slices)):
-                    # If fatsat pulse, set shim coefs to 0
-                    if options['fatsat']:
-                        for i_channel in range(n_channels):
-                            if default_coefs is None:
-                                # Output 0 (delta)
-                                f.write(f"{0:.1f}, ")
-                            else:
-                                # Output initial coefs (absolute)
-                                f.write(f"{default_coefs[i_channel]:.6f}, ")
-                        f.write(f"\n")
-
-                    for i_channel in range(n_channels):
-                        f.write(f"{coefs[i_shim, i_channel]:.6f}, ")
-                        if options['fatsat']:
-                            f_no_fatsat.write(f"{coefs[i_shim, i_channel]:.6f}, ")
-
-                    f.write("\n")
-                    if options['fatsat']:
-                        f_no_fatsat.write("\n")
-
-            elif o_format == 'slicewise-coil':
-                # Output per slice, output all channels for a particular slice, then repeat
-                # Assumes all slices are in list_slices once which is the case for ascending, descending, interleaved and
-                # volume
-                n_slices = np.sum([len(a_shim) for a_shim in list_slices])
-                for i_slice in range(n_slices):
-                    i_shim = [list_slices.index(a_shim) for a_shim in list_slices if i_slice in a_shim][0]
-                    for i_channel in range(n_channels):
-                        f.write(f"{coefs[i_shim, i_channel]:.6f}, ")
-                    f.write("\n")
-
-        if options['fatsat']:
-            f_no_fatsat.close()
+            f.write(''.join(rows))
         list_fname_output.append(os.path.abspath(fname_output))
 
     elif o_format[-3:] == '-ch':
@@ -447,27 +410,22 @@ def _save_to_text_file_static(coil, coefs, list_slices, path_output, o_format, o
                                                         f"coefs_coil{coil_number}_ch{i_channel}_{coil.name}.txt"))
 
             if o_format == 'chronological-ch':
-                with open(fname_output, 'w', encoding='utf-8') as f:
-                    # Each row will have one coef representing the shim in chronological order
-                    for i_shim in range(len(list_slices)):
-                        # If fatsat pulse, set shim coefs to 0
-                        if options['fatsat']:
-                            if default_coefs is None:
-                                # Output 0 (delta)
-                                f.write(f"{0:.1f},\n")
-                            else:
-                                # Output initial coefs (absolute)
-                                f.write(f"{default_coefs[i_channel]:.6f},\n")
-                        f.write(f"{coefs[i_shim, i_channel]:.6f},\n")
-
-            if o_format == 'slicewise-ch':
-                with open(fname_output, 'w', encoding='utf-8') as f:
-                    # Each row will have one coef representing the shim in slicewise order
-                    n_slices = np.sum([len(a_tuple) for a_tuple in list_slices])
-                    for i_slice in range(n_slices):
-                        i_shim = [list_slices.index(i) for i in list_slices if i_slice in i][0]
-                        f.write(f"{coefs[i_shim, i_channel]:.6f}\n")
+                # Each row will have one coef representing the shim in chronological order
+                rows = _format_rows(coefs[:len(list_slices), i_channel], '%.6f,')
+                if options['fatsat']:
+                    # If fatsat pulse, set shim coefs to 0 (delta) or to the initial coefs (absolute)
+                    if default_coefs is None:
+                        row_fatsat = f"{0:.1f},\n"
+                    else:
+                        row_fatsat = f"{default_coefs[i_channel]:.6f},\n"
+                    rows = [row_fatsat + row for row in rows]
 
+            else:  # o_format == 'slicewise-ch'
+                # Each row will have one coef representing the shim in slicewise order
+                rows = _format_rows(coefs[slice_to_shim, i_channel], '%.6f')
+
+            with open(fname_output, 'w', encoding='utf-8') as f:
+                f.write(''.join(rows))
             list_fname_output.append(os.path.abspath(fname_output))
     else:  # o_format == 'gradient':
 
@@ -481,27 +439,22 @@ def _save_to_text_file_static(coil, coefs, list_slices, path_output, o_format, o
                     2: 'y',
                     3: 'z'}
 
-            fname_output = os.path.join(path_output, f"{name[i_channel]}shim_gradients.txt")
-            with open(fname_output, 'w', encoding='utf-8') as f:
-                n_slices = np.sum([len(a_tuple) for a_tuple in list_slices])
-                for i_slice in range(n_slices):
-                    i_shim = [list_slices.index(i) for i in list_slices if i_slice in i][0]
-
-                    if i_channel == 0:
-                        # f0, Output is in Hz
-                        f.write(f"corr_vec[0][{i_slice}]= "
-                                f"{coefs[i_shim, i_channel]:.6f}\n")
-                    else:
-                        # For Gx, Gy, Gz: Divide by 1000 for mT/m
-                        f.write(f"corr_vec[0][{i_slice}]= "
-                                f"{coefs[i_shim, i_channel] / 1000:.6f}\n")
+            if i_channel == 0:
+                # f0, Output is in Hz
+                coefs_slices = coefs[slice_to_shim, i_channel]
+            else:
+                # For Gx, Gy, Gz: Divide by 1000 for mT/m
+                coefs_slices = coefs[slice_to_shim, i_channel] / 1000
 
-                    # Static shimming does not have a a riro component
-                    f.write(f"corr_vec[1][{i_slice}]= "
-                            f"{0:.12f}\n")
-                    # Arbitrarily chose a mean pressure of 2000 to satisfy the sequence
-                    f.write(f"corr_vec[2][{i_slice}]= {2000:.3f}\n")
+            # Static shimming does not have a a riro component
+            # Arbitrarily chose a mean pressure of 2000 to satisfy the sequence
+            rows = [f"corr_vec[0][{i_slice}]= {coef:.6f}\n"
+                    f"corr_vec[1][{i_slice}]= {0:.12f}\n"
+                    f"corr_vec[2][{i_slice}]= {2000:.3f}\n" for i_slice, coef in enumerate(coefs_slices)]
 
+            fname_output = os.path.join(path_output, f"{name[i_channel]}shim_gradients.txt")
+            with open(fname_output, 'w', encoding='utf-8') as f:
+                f.write(''.join(rows))
             list_fname_output.append(os.path.abspath(fname_output))
 
     return list_fname_output
@@ -638,29 +591,6 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
     # Prepare the output
     create_output_dir(path_output)
 
-    # Load the fieldmap
-    nii_fmap_orig = nib.load(fname_fmap)
-
-    # Make sure the fieldmap has the appropriate dimensions
-    if nii_fmap_orig.get_fdata().ndim != 4:
-        raise ValueError("Fieldmap must be 4d (dim1, dim2, dim3, t)")
-
-    # Extend the fieldmap if there are axes that have less voxels than the kernel size. This is done since we are
-    # fitting a fieldmap to coil profiles and having a small number of voxels can lead to errors in fitting (2 voxels
-    # in one dimension can differentiate order 1 at most), the parameter allows to have at least the size of the kernel
-    # for each dimension This is usually useful in the through plane direction where we could have less slices.
-    # To mitigate this, we create a 3d volume by replicating the slices on the edges.
-    extending = False
-    for i_axis in range(3):
-        if nii_fmap_orig.shape[i_axis] < dilation_kernel_size:
-            extending = True
-            break
-
-    if extending:
-        nii_fmap = extend_fmap_to_kernel_size(nii_fmap_orig, dilation_kernel_size, path_output)
-    else:
-        nii_fmap = copy.deepcopy(nii_fmap_orig)
-
     # Load the anat
     nii_anat = nib.load(fname_anat)
     dim_info = nii_anat.header.get_dim_info()
@@ -670,16 +600,23 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
         raise RuntimeError("Slice encode direction must be the 3rd dimension of the NIfTI file.")
 
     # Load anat json
-    fname_anat_json = fname_anat.rsplit('.nii', 1)[0] + '.json'
-    with open(fname_anat_json) as json_file:
-        json_anat_data = json.load(json_file)
+    fname_anat_json = _get_fname_json(fname_anat)
+    json_anat_data = _read_json(fname_anat_json)
+
+    # Open json of the fmap, check it exists before loading any data
+    fname_json = _get_fname_json(fname_fmap)
+    # Read from json file
+    if os.path.isfile(fname_json):
+        json_fm_data = _read_json(fname_json)
+    else:
+        raise OSError("Missing fieldmap json file")
 
     # Load static mask
     if fname_mask_anat_static is not None:
         nii_mask_anat_static = nib.load(fname_mask_anat_static)
     else:
         # If no mask is provided, shim the whole anat volume
-        nii_mask_anat_static = nib.Nifti1Image(np.ones_like(nii_anat.get_fdata()), nii_anat.affine,
+        nii_mask_anat_static = nib.Nifti1Image(np.ones(nii_anat.shape, dtype=np.float32), nii_anat.affine,
                                                header=nii_anat.header)
 
     # Load riro mask
@@ -687,18 +624,9 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
         nii_mask_anat_riro = nib.load(fname_mask_anat_riro)
     else:
         # If no mask is provided, shim the whole anat volume
-        nii_mask_anat_riro = nib.Nifti1Image(np.ones_like(nii_anat.get_fdata()), nii_anat.affine,
+        nii_mask_anat_riro = nib.Nifti1Image(np.ones(nii_anat.shape, dtype=np.float32), nii_anat.affine,
                                              header=nii_anat.header)
 
-    # Open json of the fmap
-    fname_json = fname_fmap.split('.nii')[0] + '.json'
-    # Read from json file
-    if os.path.isfile(fname_json):
-        with open(fname_json) as json_file:
-            json_fm_data = json.load(json_file)
-    else:
-        raise OSError("Missing fieldmap json file")
-
     # Error out for unsupported inputs. If file format is in gradient CS, it must be 1st order and the output format be
     # delta.
     if o_format_sph == 'gradient':
@@ -713,6 +641,9 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
             raise ValueError(f"Unsupported manufacturer: {json_fm_data['manufacturer']} for output file format: "
                              f"{o_format_sph}")
 
+    # Load the fieldmap, all the inputs have been validated
+    nii_fmap_orig, nii_fmap = _load_fmap(fname_fmap, 4, dilation_kernel_size, path_output)
+
     # Read the current shim settings from the scanner
     all_scanner_orders = set(scanner_coil_order_static).union(set(scanner_coil_order_riro))
     scanner_shim_settings = ScannerShimSettings(json_fm_data, orders=all_scanner_orders)
@@ -734,11 +665,13 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
     # Get the shim slice ordering
     n_slices = nii_anat.shape[2]
     if slices == 'auto':
-        list_slices = parse_slices(fname_anat)
+        list_slices = parse_slices(fname_anat, json_anat_data)
     else:
         list_slices = define_slices(n_slices, slice_factor, slices, json_fm_data.get('SoftwareVersions'))
 
     logger.info(f"The slices to shim are: {list_slices}")
+    # Index of the shim group of each slice, shared by all the outputs
+    slice_to_shim = _get_slice_to_shim(list_slices)
 
     # Load PMU
     pmu = PmuResp(fname_resp)
@@ -791,6 +724,11 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
                 coil_indexes_riro[coil.name][key] = [index, index + len(coil.coef_channel_minmax[key])]
                 index += len(coil.coef_channel_minmax[key])
 
+    # Same for all the coils, decided once
+    manufacturer = json_anat_data.get('Manufacturer')
+    # Orders converted to the gradient CS, f0 is not converted
+    orders_gradient = tuple([order for order in scanner_coil_order_static if order != 0])
+
     list_fname_output = []
     for i_coil, coil in enumerate(all_coils):
         # Figure out the start and end channels for a coil to be able to select it from the coefs
@@ -811,8 +749,8 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
             for key in keys:
                 if coil in list_coils_riro:
                     if key in coil_indexes_riro[coil.name]:
-                        coefs_coil_riro = copy.deepcopy(
-                            coefs_riro[:, coil_indexes_riro[coil.name][key][0]:coil_indexes_riro[coil.name][key][1]])
+                        coefs_coil_riro = coefs_riro[:, coil_indexes_riro[coil.name][key][0]:
+                                                        coil_indexes_riro[coil.name][key][1]].copy()
                     else:
                         coefs_coil_riro = np.zeros_like(coefs_static[:, coil_indexes_static[coil.name][key][0]:
                                                                         coil_indexes_static[coil.name][key][1]])
@@ -822,14 +760,13 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
 
                 if coil in list_coils_static:
                     if key in coil_indexes_static[coil.name]:
-                        coefs_coil_static = copy.deepcopy(coefs_static[:, coil_indexes_static[coil.name][key][0]:
-                                                                          coil_indexes_static[coil.name][key][1]])
+                        coefs_coil_static = coefs_static[:, coil_indexes_static[coil.name][key][0]:
+                                                            coil_indexes_static[coil.name][key][1]].copy()
                     else:
                         coefs_coil_static = np.zeros_like(coefs_coil_riro)
                 else:
                     coefs_coil_static = np.zeros_like(coefs_coil_riro)
 
-                manufacturer = json_anat_data['Manufacturer']
                 # If outputting in the gradient CS, it must be the 1st order and must be in the delta CS and Siemens
                 # The check has already been done earlier in the program to avoid processing and throw an error
                 # afterwards.
@@ -854,151 +791,185 @@ def realtime_dynamic(fname_fmap, fname_anat, fname_mask_anat_static, fname_mask_
                     coefs_coil_static = save_coefs_static
                     coefs_coil_riro = save_coefs_riro
                     logger.debug("Converting scanner coil from Shim CS to Gradient CS")
-                    orders_static = tuple([order for order in scanner_coil_order_static if order != 0])
-                    orders_riro = tuple([order for order in scanner_coil_order_riro if order != 0])
-                    # First convert coefficients from Shim CS to RAS
-                    for i_shim in range(coefs_coil_static.shape[0]):
-                        # Convert coefficient
-                        coefs_coil_static[i_shim, 1:] = shim_to_phys_cs(coefs_coil_static[i_shim, 1:], manufacturer,
-                                                                        orders_static)
-                        coefs_coil_riro[i_shim, 1:] = shim_to_phys_cs(coefs_coil_riro[i_shim, 1:], manufacturer,
-                                                                      orders_riro)
-
-                    # RAS to gradient
-                    coefs_st_freq, coefs_st_phase, coefs_st_slice = phys_to_gradient_cs(
-                        coefs_coil_static[:, 1],
-                        coefs_coil_static[:, 2],
-                        coefs_coil_static[:, 3],
-                        fname_anat)
-                    coefs_coil_static[:, 1] = coefs_st_freq
-                    coefs_coil_static[:, 2] = coefs_st_phase
-                    coefs_coil_static[:, 3] = coefs_st_slice
-
-                    coefs_riro_freq, coefs_riro_phase, coefs_riro_slice = phys_to_gradient_cs(
-                        coefs_coil_riro[:, 1],
-                        coefs_coil_riro[:, 2],
-                        coefs_coil_riro[:, 3],
-                        fname_anat)
-                    coefs_coil_riro[:, 1] = coefs_riro_freq
-                    coefs_coil_riro[:, 2] = coefs_riro_phase
-                    coefs_coil_riro[:, 3] = coefs_riro_slice
+                    # The static and riro orders have been checked to both be 1st order, static and riro are stacked
+                    # (2 x n_shims x n_channels) to be converted at the same time
+                    coefs_coil_static, coefs_coil_riro = _shim_to_gradient_cs(
+                        np.stack([coefs_coil_static, coefs_coil_riro]), manufacturer, orders_gradient, nii_anat,
+                        json_anat_data)
 
                 else:
 
                     # If the output format is absolute, add the initial coefs
                     if output_value_format == 'absolute' and coefs_coil_static is not None:
                         initial_coefs = scanner_shim_settings.concatenate_shim_settings(scanner_coil_order_static)
-                        for i_channel in range(coefs_coil_static.shape[-1]):
-                            # abs_coef = delta + initial
-                            coefs_coil_static[:, i_channel] = coefs_coil_static[:, i_channel] + initial_coefs[i_channel]
-                            # riro does not change
-
-                            list_fname_output += _save_to_text_file_rt(coil, coefs_coil_static, coefs_coil_riro, mean_p,
-                                                                       list_slices, path_output, o_format_sph, options,
-                                                                       i_coil, int(key) ** 2,
-                                                                       default_st_coefs=initial_coefs)
+                        # Select the initial coefs of the current order, the orders are concatenated in ascending order
+                        start_initial = sum([channels_per_order(order) for order in scanner_coil_order_static
+                                             if order < int(key)])
+                        initial_coefs_order = initial_coefs[start_initial:
+                                                            start_initial + coefs_coil_static.shape[-1]]
+                        # abs_coef = delta + initial
+                        coefs_coil_static += initial_coefs_order
+                        # riro does not change
+
+                        list_fname_output += _save_to_text_file_rt(coil, coefs_coil_static, coefs_coil_riro, mean_p,
+                                                                   list_slices, path_output, o_format_sph, options,
+                                                                   i_coil, int(key) ** 2,
+                                                                   default_st_coefs=initial_coefs_order,
+                                                                   slice_to_shim=slice_to_shim)
                         continue
 
                 list_fname_output += _save_to_text_file_rt(coil, coefs_coil_static, coefs_coil_riro, mean_p,
-                                                           list_slices,
-                                                           path_output, o_format_sph, options, i_coil, int(key) ** 2)
+                                                           list_slices, path_output, o_format_sph, options, i_coil,
+                                                           int(key) ** 2, slice_to_shim=slice_to_shim)
 
         else:  # Custom coil
             if coil in list_coils_riro:
-                coefs_coil_riro = copy.deepcopy(
-                    coefs_riro[:, coil_indexes_riro[coil.name][0]:coil_indexes_riro[coil.name][1]])
+                coefs_coil_riro = coefs_riro[:, coil_indexes_riro[coil.name][0]:
+                                                coil_indexes_riro[coil.name][1]].copy()
             else:
                 coefs_coil_riro = np.zeros_like(
                     coefs_static[:, coil_indexes_static[coil.name][0]:coil_indexes_static[coil.name][1]])
             if coil in list_coils_static:
-                coefs_coil_static = copy.deepcopy(
-                    coefs_static[:, coil_indexes_static[coil.name][0]:coil_indexes_static[coil.name][1]])
+                coefs_coil_static = coefs_static[:, coil_indexes_static[coil.name][0]:
+                                                    coil_indexes_static[coil.name][1]].copy()
             else:
                 coefs_coil_static = np.zeros_like(coefs_coil_riro)
 
             list_fname_output += _save_to_text_file_rt(coil, coefs_coil_static, coefs_coil_riro, mean_p, list_slices,
-                                                       path_output, o_format_coil, options, i_coil, 0)
+                                                       path_output, o_format_coil, options, i_coil, 0,
+                                                       slice_to_shim=slice_to_shim)
 
     logger.info(f"Coil txt file(s) are here:\n{os.linesep.join(list_fname_output)}")
     logger.info(f"Plotting figure(s)")
     sequencer.eval(coefs_static, coefs_riro, mean_p, p_rms)
     logger.info(f"Plotting Currents")
-    # Plot the coefs after outputting the currents to the text file
-    end_channel = 0
+    if logger.level <= getattr(logging, 'DEBUG'):
+        # Plot the coefs after outputting the currents to the text file
+        list_plot_jobs = []
+        for i_coil, coil in enumerate(all_coils):
+            # Figure out the start and end channels for a coil to be able to select it from the coefs
+            if type(coil) != ScannerCoil:
+                if coil in list_coils_riro:
+                    coefs_coil_riro = coefs_riro[:, coil_indexes_riro[coil.name][0]:
+                                                    coil_indexes_riro[coil.name][1]].copy()
+                else:
+                    coefs_coil_riro = None
+                if coil in list_coils_static:
+                    coefs_coil_static = coefs_static[:, coil_indexes_static[coil.name][0]:
+                                                        coil_indexes_static[coil.name][1]].copy()
+                else:
+                    coefs_coil_static = np.zeros_like(coefs_coil_riro)
+                # Plot a figure of the coefficients
+                list_plot_jobs.append(
+                    delayed(_plot_coefs_worker)(verbose, coil.name, list_slices, coefs_coil_static, path_output,
+                                                i_coil, coefs_coil_riro, pres_probe_max=pmu.max - mean_p,
+                                                pres_probe_min=pmu.min - mean_p,
+                                                bounds=[bound for bounds in coil.coef_channel_minmax.values()
+                                                        for bound in bounds]))
 
-    for i_coil, coil in enumerate(all_coils):
-        # Figure out the start and end channels for a coil to be able to select it from the coefs
-        if type(coil) != ScannerCoil:
-            if coil in list_coils_riro:
-                coefs_coil_riro = copy.deepcopy(
-                    coefs_riro[:, coil_indexes_riro[coil.name][0]:coil_indexes_riro[coil.name][1]])
-            else:
-                coefs_coil_riro = None
-            if coil in list_coils_static:
-                coefs_coil_static = copy.deepcopy(
-                    coefs_static[:, coil_indexes_static[coil.name][0]:coil_indexes_static[coil.name][1]])
-            else:
-                coefs_coil_static = np.zeros_like(coefs_coil_riro)
-            # Plot a figure of the coefficients
-            _plot_coefs(coil, list_slices, coefs_coil_static, path_output, i_coil, coefs_coil_riro,
-                        pres_probe_max=pmu.max - mean_p, pres_probe_min=pmu.min - mean_p,
-                        bounds=[bound for bounds in coil.coef_channel_minmax.values() for bound in bounds])
+        # Rendering is CPU bound, each coil is plotted in its own process
+        Parallel(-1, backend='loky')(list_plot_jobs)
+
+        logger.info(f"Finished plotting figure(s)")
+
+
+def _shim_to_gradient_cs(coefs, manufacturer, orders, nii_anat, json_anat):
+    """ Convert f0 and 1st order scanner coefficients from the Shim CS to the Gradient CS
+
+    Args:
+        coefs (np.ndarray): Coefficients (..., n_shims, 4) of the f0, x, y and z channels in the Shim CS. Leading
+                            dimensions (i.e. static and riro stacked together) are converted at the same time.
+        manufacturer (str): Name of the MRI manufacturer
+        orders (tuple): Spherical harmonic orders of the x, y and z channels (without the 0th order)
+        nii_anat (nib.Nifti1Image): Target image defining the Gradient CS
+        json_anat (dict): BIDS sidecar of the target image
+
+    Returns:
+        np.ndarray: Coefficients in the Gradient CS (f0, frequency, phase, slice), f0 is not modified
+    """
+    coefs = coefs.copy()
+    # Shim CS to RAS, shim_to_phys_cs expects the channels along the first dimension
+    coefs_xyz = np.moveaxis(coefs[..., 1:], -1, 0)
+    coefs[..., 1:] = np.moveaxis(shim_to_phys_cs(coefs_xyz, manufacturer, orders), 0, -1)
 
-    logger.info(f"Finished plotting figure(s)")
+    # RAS to Gradient CS
+    coefs[..., 1], coefs[..., 2], coefs[..., 3] = phys_to_gradient_cs(coefs[..., 1], coefs[..., 2], coefs[..., 3],
+                                                                      nii_anat, json_anat)
+
+    return coefs
 
 
 def _save_to_text_file_rt(coil, currents_static, currents_riro, mean_p, list_slices, path_output, o_format,
-                          options, coil_number, channel_start, default_st_coefs=None):
-    """o_format can either be 'chronological-ch', 'chronological-coil', 'gradient'"""
+                          options, coil_number, channel_start, default_st_coefs=None, slice_to_shim=None):
+    """o_format can either be 'chronological-ch', 'chronological-coil', 'gradient'
+    slice_to_shim is the output of _get_slice_to_shim(list_slices), it is calculated if not provided."""
 
+    if slice_to_shim is None:
+        # Index of the shim group of each slice
+        slice_to_shim = _get_slice_to_shim(list_slices)
     list_fname_output = []
     if currents_riro is not None:
         n_channels = currents_riro.shape[-1]
     else:
         n_channels = currents_static.shape[-1]
+    # Computed once for all the channels
+    n_slices = len(slice_to_shim)
+    slice_numbers = np.arange(n_slices)
+
+    # Select the rows of all the channels at once
+    if o_format == 'chronological-ch':
+        # One row per shim in chronological order
+        i_rows = np.arange(len(list_slices))
+    else:
+        # One row per slice in slicewise order
+        i_rows = slice_to_shim
+    if currents_static is not None:
+        currents_static = currents_static[i_rows]
+    if currents_riro is not None:
+        currents_riro = currents_riro[i_rows]
+
+    if o_format == 'gradient':
+        # Make sure there are 4 channels
+        if n_channels != 4:
+            raise RuntimeError("Gradient output format should only be used with 1st order scanner coils")
+
+        # Scale all the channels at once. f0 is output in Hz. For Gx, Gy, Gz: Divide by 1000 for mT/m
+        scale = np.array([1, 1000, 1000, 1000])
+        if currents_static is not None:
+            currents_static = currents_static / scale
+        if currents_riro is not None:
+            currents_riro = currents_riro / scale
+
+    # The content of each file is formatted in memory and written at once
     # Write a file for each channel
     for i_channel in range(n_channels):
 
-        if o_format == 'chronological-ch':
-            fname_output = os.path.join(path_output,
-                                        f"coefs_coil{coil_number}_ch{channel_start + i_channel}_{coil.name}.txt")
-            with open(fname_output, 'w', encoding='utf-8') as f:
-                # Each row will have 3 coef representing the static, riro and mean_p in chronological order
-                for i_shim in range(len(list_slices)):
-                    # If fatsat pulse, set shim coefs to 0 and output mean pressure
-                    if options['fatsat']:
-                        if default_st_coefs is None:
-                            # Output 0 (delta)
-                            f.write(f"{0:.1f}, {0:.1f}, {mean_p:.4f},\n")
-                        else:
-                            # Output initial coefs (absolute)
-                            f.write(f"{default_st_coefs[i_channel]:.1f}, {0:.1f}, {mean_p:.4f},\n")
-                    if currents_static is not None:
-                        f.write(f"{currents_static[i_shim, i_channel]:.6f}, ")
-                    if currents_riro is not None:
-                        f.write(f"{currents_riro[i_shim, i_channel]:.12f}, ")
-                    f.write(f"{mean_p:.4f},\n")
-
-        elif o_format == 'slicewise-ch':
+        if o_format[-3:] == '-ch':
             fname_output = os.path.join(path_output,
                                         f"coefs_coil{coil_number}_ch{channel_start + i_channel}_{coil.name}.txt")
-            with open(fname_output, 'w', encoding='utf-8') as f:
-                # Each row will have one coef representing the static, riro and mean_p in slicewise order
-                n_slices = np.sum([len(a_tuple) for a_tuple in list_slices])
-                for i_slice in range(n_slices):
-                    i_shim = [list_slices.index(i) for i in list_slices if i_slice in i][0]
-
-                    if currents_static is not None:
-                        f.write(f"{currents_static[i_shim, i_channel]:.6f}, ")
-                    if currents_riro is not None:
-                        f.write(f"{currents_riro[i_shim, i_channel]:.12f}, ")
-                    f.write(f"{mean_p:.4f},\n")
+            # Each row will have 3 coef representing the static, riro and mean_p in chronological or slicewise order
+            fmt = ''
+            columns = []
+            if currents_static is not None:
+                fmt += "%.6f, "
+                columns.append(currents_static[:, i_channel])
+            if currents_riro is not None:
+                fmt += "%.12f, "
+                columns.append(currents_riro[:, i_channel])
+            rows = _format_rows(np.column_stack(columns), fmt + f"{mean_p:.4f},")
+
+            # If fatsat pulse, set shim coefs to 0 and output mean pressure
+            if o_format == 'chronological-ch' and options['fatsat']:
+                if default_st_coefs is None:
+                    # Output 0 (delta)
+                    row_fatsat = f"{0:.1f}, {0:.1f}, {mean_p:.4f},\n"
+                else:
+                    # Output initial coefs (absolute)
+                    row_fatsat = f"{default_st_coefs[i_channel]:.1f}, {0:.1f}, {mean_p:.4f},\n"
+                rows = [row_fatsat + row for row in rows]
 
         else:  # o_format == 'gradient':
-
-            # Make sure there are 4 channels
-            if n_channels != 4:
-                raise RuntimeError("Gradient output format should only be used with 1st order scanner coils")
+            # The currents have already been scaled
 
             name = {0: 'f0',
                     1: 'x',
@@ -1006,31 +977,23 @@ def _save_to_text_file_rt(coil, currents_static, currents_riro, mean_p, list_sli
                     3: 'z'}
 
             fname_output = os.path.join(path_output, f"{name[i_channel]}shim_gradients.txt")
-            with open(fname_output, 'w', encoding='utf-8') as f:
-                n_slices = np.sum([len(a_tuple) for a_tuple in list_slices])
-                for i_slice in range(n_slices):
-                    i_shim = [list_slices.index(i) for i in list_slices if i_slice in i][0]
-
-                    if i_channel == 0:
-                        # f0, Output is in Hz
-                        if currents_static is not None:
-                            f.write(f"corr_vec[0][{i_slice}]= "
-                                    f"{currents_static[i_shim, i_channel]:.6f}\n")
-                        if currents_riro is not None:
-                            f.write(f"corr_vec[1][{i_slice}]= "
-                                    f"{currents_riro[i_shim, i_channel]:.12f}\n")
-                        f.write(f"corr_vec[2][{i_slice}]= {mean_p:.3f}\n")
 
-                    else:
-                        # For Gx, Gy, Gz: Divide by 1000 for mT/m
-                        if currents_static is not None:
-                            f.write(f"corr_vec[0][{i_slice}]= "
-                                    f"{currents_static[i_shim, i_channel] / 1000:.6f}\n")
-                        if currents_riro is not None:
-                            f.write(f"corr_vec[1][{i_slice}]= "
-                                    f"{currents_riro[i_shim, i_channel] / 1000:.12f}\n")
-                        f.write(f"corr_vec[2][{i_slice}]= {mean_p:.3f}\n")
+            # Each slice is a row of the table formatted by a multi-line template: the slice number followed by its
+            # value for each line of the template
+            fmt = []
+            columns = []
+            if currents_static is not None:
+                fmt.append("corr_vec[0][%d]= %.6f")
+                columns += [slice_numbers, currents_static[:, i_channel]]
+            if currents_riro is not None:
+                fmt.append("corr_vec[1][%d]= %.12f")
+                columns += [slice_numbers, currents_riro[:, i_channel]]
+            fmt.append(f"corr_vec[2][%d]= {mean_p:.3f}")
+            columns.append(slice_numbers)
+            rows = _format_rows(np.column_stack(columns), '\n'.join(fmt))
 
+        with open(fname_output, 'w', encoding='utf-8') as f:
+            f.write(''.join(rows))
         list_fname_output.append(os.path.abspath(fname_output))
 
     return list_fname_output
@@ -1048,6 +1011,58 @@ def parse_orders(orders: str):
         raise ValueError(f"Invalid orders: {orders}\n Orders must be integers ")
 
 
+def _load_fmap(fname_fmap, n_dims, dilation_kernel_size, path_output):
+    """ Load the fieldmap and extend it if it has less voxels than the kernel size
+
+    Args:
+        fname_fmap (str): Filename of the fieldmap
+        n_dims (int): Number of dimensions of the fieldmap. 3 for static shimming (a 2d fieldmap is also accepted, a
+                      singleton is added as the 3rd dimension), 4 for realtime shimming (dim1, dim2, dim3, t).
+        dilation_kernel_size (int): Size of the kernel
+        path_output (str): Path to save the debug output
+
+    Returns:
+        (tuple): tuple containing:
+
+            * nib.Nifti1Image: Nibabel object of the fieldmap as loaded from the file
+            * nib.Nifti1Image: Nibabel object of the fieldmap extended to the kernel size
+    """
+    nii_fmap_orig = nib.load(fname_fmap)
+
+    # Make sure the fieldmap has the appropriate dimensions, the header is enough, the data is not read
+    if len(nii_fmap_orig.shape) != n_dims:
+        if n_dims == 3 and len(nii_fmap_orig.shape) == 2:
+            # Add a singleton as the 3rd dimension. The data is read through the dataobj to keep the data type of the
+            # file, extend_fmap_to_kernel_size also keeps it. The sequencer converts it to float when it uses it.
+            fmap = np.asanyarray(nii_fmap_orig.dataobj)
+            nii_fmap = nib.Nifti1Image(fmap.reshape(fmap.shape + (1,)), nii_fmap_orig.affine,
+                                       header=nii_fmap_orig.header)
+            nii_fmap = extend_fmap_to_kernel_size(nii_fmap, dilation_kernel_size, path_output)
+            return nii_fmap_orig, nii_fmap
+        elif n_dims == 3:
+            raise ValueError("Fieldmap must be 2d or 3d")
+        else:
+            raise ValueError("Fieldmap must be 4d (dim1, dim2, dim3, t)")
+
+    # Extend the fieldmap if there are axes that have less voxels than the kernel size. This is done since we are
+    # fitting a fieldmap to coil profiles and having a small number of voxels can lead to errors in fitting (2 voxels
+    # in one dimension can differentiate order 1 at most), the parameter allows to have at least the size of the kernel
+    # for each dimension This is usually useful in the through plane direction where we could have less slices.
+    # To mitigate this, we create a 3d volume by replicating the slices on the edges.
+    extending = False
+    for i_axis in range(3):
+        if nii_fmap_orig.shape[i_axis] < dilation_kernel_size:
+            extending = True
+            break
+
+    if extending:
+        nii_fmap = extend_fmap_to_kernel_size(nii_fmap_orig, dilation_kernel_size, path_output)
+    else:
+        nii_fmap = copy.deepcopy(nii_fmap_orig)
+
+    return nii_fmap_orig, nii_fmap
+
+
 def _load_coils(coils, orders, fname_constraints, nii_fmap, scanner_shim_settings, manufacturer,
                 manufacturers_model_name):
     """ Loads the Coil objects from filenames
@@ -1069,8 +1084,7 @@ def _load_coils(coils, orders, fname_constraints, nii_fmap, scanner_shim_setting
     # Load custom coils
     for coil in coils:
         nii_coil_profiles = nib.load(coil[0])
-        with open(coil[1]) as json_file:
-            constraints = json.load(json_file)
+        constraints = _read_json(coil[1])
         list_coils.append(Coil(nii_coil_profiles.get_fdata(), nii_coil_profiles.affine, constraints))
 
     if len(list_coils) != len(set(list_coils)):
@@ -1080,8 +1094,7 @@ def _load_coils(coils, orders, fname_constraints, nii_fmap, scanner_shim_setting
     if -1 not in orders:
 
         if os.path.isfile(fname_constraints):
-            with open(fname_constraints) as json_file:
-                sph_contraints = json.load(json_file)
+            sph_contraints = _read_json(fname_constraints)
             orders_to_delete = []
             for key in sph_contraints['coef_channel_minmax']:
                 if key not in str(orders):
@@ -1103,6 +1116,26 @@ def _load_coils(coils, orders, fname_constraints, nii_fmap, scanner_shim_setting
     return list_coils
 
 
+def _read_json(fname_json):
+    """ Reads and parses a json file, orjson is used if it is installed
+
+    Args:
+        fname_json (str): Filename of the json file
+
+    Returns:
+        dict: Content of the json file
+    """
+    with open(fname_json, 'rb') as json_file:
+        content = json_file.read()
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson is strict (e.g. NaN is not accepted), let the standard library parse or report the error
+            pass
+    return json.loads(content)
+
+
 def calculate_scanner_constraints(constraints: dict, scanner_shim_settings, orders, manufacturer):
     """ Calculate the constraints that should be used for the scanner by considering the current shim settings and the
         absolute bounds
@@ -1161,15 +1194,72 @@ def calculate_scanner_constraints(constraints: dict, scanner_shim_settings, orde
     return constraints
 
 
+def _format_rows(coefs, fmt):
+    """ Format the rows of an array of coefficients
+
+    Args:
+        coefs (numpy.ndarray): 1D or 2D array. Each element of a 1D array or each row of a 2D array is formatted
+        fmt (str): Format of a row (see ``numpy.savetxt``)
+
+    Returns:
+        list: Formatted rows, each ending with a new line
+    """
+    buffer = io.StringIO()
+    np.savetxt(buffer, coefs, fmt=fmt)
+    return buffer.getvalue().splitlines(keepends=True)
+
+
+def _get_slice_to_shim(list_slices):
+    """ Map each slice to the index of the shim group it belongs to
+
+    Args:
+        list_slices (list): 1D array containing tuples of z slices to shim. (ie: [(0, 1), (2, 3), (4, 5)])
+
+    Returns:
+        numpy.ndarray: 1D array of length n_slices containing, for each slice, the index of its shim group in
+                       ``list_slices``. Each slice from 0 to n_slices - 1 must be in a group.
+    """
+    n_slices = sum(map(len, list_slices))
+    # Flatten the slices and the index of the shim group they belong to
+    all_slices = np.fromiter((i_slice for a_shim in list_slices for i_slice in a_shim), dtype=int, count=n_slices)
+    shim_indexes = np.repeat(np.arange(len(list_slices)), [len(a_shim) for a_shim in list_slices])
+
+    # np.unique sorts the slices and returns the index of their first occurrence
+    unique_slices, index_first = np.unique(all_slices, return_index=True)
+    missing_slices = np.setdiff1d(np.arange(n_slices), unique_slices)
+    if missing_slices.size != 0:
+        raise ValueError(f"Some slices are not part of a shim group: {missing_slices.tolist()}")
+
+    # All the slices from 0 to n_slices - 1 are present so unique_slices is np.arange(n_slices)
+    return shim_indexes[index_first]
+
+
+def _get_fname_json(fname_nii):
+    """ Returns the path of the BIDS json sidecar of a NIfTI file
+
+    Args:
+        fname_nii (str): Filename of the NIfTI file, '.nii' or '.nii.gz'
+
+    Returns:
+        str: Filename of the json sidecar
+    """
+    # Only strip the extension so that '.nii' elsewhere in the path is left untouched
+    for ext in ('.nii.gz', '.nii'):
+        if fname_nii.endswith(ext):
+            return fname_nii[:-len(ext)] + '.json'
+    return fname_nii.rsplit('.nii', 1)[0] + '.json'
+
+
 def _save_nii_to_new_dir(list_fname, path_output):
     """List of nii to save to a new output folder"""
     logger.debug(f"Saving CLI inputs to: {path_output}")
     for fname in list_fname:
         if fname is None:
             continue
-        nii = nib.load(fname)
         fname_to_save = os.path.join(path_output, os.path.basename(fname))
-        nib.save(nii, fname_to_save)
+        # The file is copied as is, there is no need to decompress and recompress it
+        if not (os.path.exists(fname_to_save) and os.path.samefile(fname, fname_to_save)):
+            shutil.copyfile(fname, fname_to_save)
 
 
 def _get_fatsat_option(json_anat, fatsat):
@@ -1234,8 +1324,41 @@ def define_slices_cli(slices, factor, method, fname_output):
     logger.info(f"The slices to shim are: {list_slices}")
 
 
+def _maybe_jit(func):
+    """ Compiles a function with numba if it is installed, numba is an optional dependency. The compiled function is
+    cached on disk to avoid compiling it at every run.
+    """
+    try:
+        import numba
+    except ImportError:
+        return func
+    return numba.njit(cache=True)(func)
+
+
+@_maybe_jit
+def _compute_rt_extent(static_coefs, rt_coefs, pres_probe_min, pres_probe_max):
+    """ Returns the min and max of static + riro * (acq_pressure - mean_p) over the range of pressures """
+    # The lowest value is reached at the min pressure for a positive riro coef and at the max pressure otherwise
+    extent_min = static_coefs + np.where(rt_coefs > 0, rt_coefs * pres_probe_min, rt_coefs * pres_probe_max)
+    extent_max = static_coefs + np.where(rt_coefs > 0, rt_coefs * pres_probe_max, rt_coefs * pres_probe_min)
+    return extent_min.min(), extent_max.max()
+
+
+def _plot_coefs_worker(verbose, *args, **kwargs):
+    """ Calls _plot_coefs from a worker process. The loggers of a new process are not set up by the CLI, set them to
+    the verbosity of the CLI so that the debug output of the plotting is not lost.
+
+    Args:
+        verbose (str): Verbosity level of the CLI
+        *args: Positional arguments of _plot_coefs
+        **kwargs: Keyword arguments of _plot_coefs
+    """
+    set_all_loggers(verbose)
+    _plot_coefs(*args, **kwargs)
+
+
 @timeit
-def _plot_coefs(coil, slices, static_coefs, path_output, coil_number, rt_coefs=None, pres_probe_min=None,
+def _plot_coefs(coil_name, slices, static_coefs, path_output, coil_number, rt_coefs=None, pres_probe_min=None,
                 pres_probe_max=None, units='', bounds=None):
     # Find which slices are not shimmed and group them (smaller file size and reduce the plot saving time)
     shimmed_slice_index = []
@@ -1271,37 +1394,31 @@ def _plot_coefs(coil, slices, static_coefs, path_output, coil_number, rt_coefs=N
     # Calculate the min and max coefficient for the combined static + riro * (acq_pressure - mean_p)
     # It can expand the min/max of the bounds if necessary
     if rt_coefs is not None:
-        for i_shim in range(n_shims):
-            n_channels = static_coefs.shape[1]
-            for i_channel in range(n_channels):
-                coef = rt_coefs[i_shim, i_channel]
-                if coef > 0:
-                    temp_min = static_coefs[i_shim, i_channel] + coef * pres_probe_min
-                    temp_max = static_coefs[i_shim, i_channel] + coef * pres_probe_max
-                else:
-                    temp_min = static_coefs[i_shim, i_channel] + coef * pres_probe_max
-                    temp_max = static_coefs[i_shim, i_channel] + coef * pres_probe_min
-
-                if min_y is None or min_y > temp_min:
-                    min_y = temp_min
-                if max_y is None or max_y < temp_max:
-                    max_y = temp_max
+        temp_min, temp_max = _compute_rt_extent(np.asarray(static_coefs, dtype=float),
+                                                np.asarray(rt_coefs, dtype=float),
+                                                float(pres_probe_min), float(pres_probe_max))
+        if min_y is None or min_y > temp_min:
+            min_y = temp_min
+        if max_y is None or max_y < temp_max:
+            max_y = temp_max
 
     # If its static optimization, find the min and max. It can expand the bounds.
     else:
-        temp_min = np.array(static_coefs).min()
+        static_coefs = np.asarray(static_coefs)
+        temp_min = static_coefs.min()
         if min_y is None or min_y > temp_min:
             min_y = temp_min
-        temp_max = np.array(static_coefs).max()
+        temp_max = static_coefs.max()
         if max_y is None or max_y < temp_max:
-            max_y = np.array(static_coefs).max()
+            max_y = temp_max
 
     # Plot the currents
     n_plots = len(shimmed_slice_index)
     if unused_slice:
         n_plots += 1
 
-    fig = Figure(figsize=(8, 4 * n_plots), tight_layout=True)
+    # Cap the height, the subplots are shrunk when there are more than 10 shim groups
+    fig = Figure(figsize=(8, min(4 * n_plots, MAX_FIGURE_HEIGHT)), tight_layout=True)
     for i_plot, slice_index in enumerate(shimmed_slice_index):
 
         if rt_coefs is not None:
@@ -1320,7 +1437,7 @@ def _plot_coefs(coil, slices, static_coefs, path_output, coil_number, rt_coefs=N
                         min_y, max_y, units, slices_wo_shim)
 
     # Save the figure
-    fname_figure = os.path.join(path_output, f"fig_currents_per_slice_group_coil{coil_number}_{coil.name}.png")
+    fname_figure = os.path.join(path_output, f"fig_currents_per_slice_group_coil{coil_number}_{coil_name}.png")
     fig.savefig(fname_figure, bbox_inches='tight')
     logger.debug(f"Saved figure: {fname_figure}")
 
@@ -1360,36 +1477,19 @@ def _add_sub_figure(fig, i_plot, n_plots, static_coefs, bounds, min_y, max_y, un
             ax.hlines(bounds[0, 1], 0 - len_hline_bounds, n_channels + len_hline_bounds, colors='r',
                       capstyle='projecting')
         else:
-            # Channel 0 used for the legend
-            # min
-            ax.hlines(bounds[0, 0], -len_hline_bounds, len_hline_bounds, colors='r', label='bounds',
-                      capstyle='projecting')
-            ax.vlines(-len_hline_bounds, bounds[0, 0], bounds[0, 0] + (delta_y * len_vline_bounds), colors='r',
-                      capstyle='projecting')
-            ax.vlines(len_hline_bounds, bounds[0, 0], bounds[0, 0] + (delta_y * len_vline_bounds), colors='r',
-                      capstyle='projecting')
-            # max
-            ax.hlines(bounds[0, 1], -len_hline_bounds, len_hline_bounds, colors='r', capstyle='projecting')
-            ax.vlines(-len_hline_bounds, bounds[0, 1] - (delta_y * len_vline_bounds), bounds[0, 1], colors='r',
-                      capstyle='projecting')
-            ax.vlines(len_hline_bounds, bounds[0, 1] - (delta_y * len_vline_bounds), bounds[0, 1], colors='r',
-                      capstyle='projecting')
-            # All other channels
-            for i_channel in range(1, n_channels):
-                # min
-                ax.hlines(bounds[i_channel, 0], i_channel - len_hline_bounds, i_channel + len_hline_bounds, colors='r',
-                          capstyle='projecting')
-                ax.vlines(i_channel - len_hline_bounds, bounds[i_channel, 0],
-                          bounds[i_channel, 0] + (delta_y * len_vline_bounds), colors='r', capstyle='projecting')
-                ax.vlines(i_channel + len_hline_bounds, bounds[i_channel, 0],
-                          bounds[i_channel, 0] + (delta_y * len_vline_bounds), colors='r', capstyle='projecting')
-                # max
-                ax.hlines(bounds[i_channel, 1], i_channel - len_hline_bounds, i_channel + len_hline_bounds, colors='r',
-                          capstyle='projecting')
-                ax.vlines(i_channel - len_hline_bounds, bounds[i_channel, 1] - (delta_y * len_vline_bounds),
-                          bounds[i_channel, 1], colors='r', capstyle='projecting')
-                ax.vlines(i_channel + len_hline_bounds, bounds[i_channel, 1] - (delta_y * len_vline_bounds),
-                          bounds[i_channel, 1], colors='r', capstyle='projecting')
+            # All the segments of a kind are drawn in a single call (one LineCollection) instead of one per channel
+            channels = np.arange(n_channels)
+            len_vline = delta_y * len_vline_bounds
+            # Horizontal line at the min and at the max bound of each channel
+            ax.hlines(np.concatenate([bounds[:, 0], bounds[:, 1]]),
+                      np.tile(channels - len_hline_bounds, 2), np.tile(channels + len_hline_bounds, 2), colors='r',
+                      label='bounds', capstyle='projecting')
+            # Vertical ticks at both ends of the horizontal lines, pointing inwards
+            x_ticks = np.concatenate([channels - len_hline_bounds, channels + len_hline_bounds])
+            y_min = np.tile(bounds[:, 0], 2)
+            y_max = np.tile(bounds[:, 1], 2)
+            ax.vlines(np.tile(x_ticks, 2), np.concatenate([y_min, y_max - len_vline]),
+                      np.concatenate([y_min + len_vline, y_max]), colors='r', capstyle='projecting')
     # Set the extent of the plot
     ax.set(ylim=(min_y - (0.05 * delta_y), max_y + (0.05 * delta_y)), xlim=(-0.75, n_channels - 0.25),
            xticks=range(n_channels))
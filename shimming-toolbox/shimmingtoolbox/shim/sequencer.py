@@ -2019,21 +2019,24 @@ def new_bounds_from_currents_static_to_riro(currents, old_bounds, coils_static=[
     return new_bounds
 
 
-def parse_slices(fname_nifti):
+def parse_slices(fname_nifti, json_data=None):
     """
     Parse the BIDS sidecar associated with the input nifti file.
 
     Args:
         fname_nifti (str): Full path to a NIfTI file
+        json_data (dict): BIDS sidecar of the NIfTI file if it was already loaded. If None, the sidecar is read from
+                          the disk.
     Returns:
         list: 1D list containing tuples of dim3 slices to shim. (dim1, dim2, dim3)
     """
 
-    # Open json
-    fname_json = fname_nifti.split('.nii')[0] + '.json'
-    # Read from json file
-    with open(fname_json) as json_file:
-        json_data = json.load(json_file)
+    if json_data is None:
+        # Open json
+        fname_json = fname_nifti.split('.nii')[0] + '.json'
+        # Read from json file
+        with open(fname_json) as json_file:
+            json_data = json.load(json_file)
 
     # The BIDS specification mentions that the 'SliceTiming' is stored on disk depending on the
     # 'SliceEncodingDirection'. If this tag is 'i', 'j', 'k' or non existent, index 0 of 'SliceTiming' corresponds to
@@ -2048,7 +2051,8 @@ def parse_slices(fname_nifti):
 
     # Make sure tag SliceTiming exists
     if 'SliceTiming' in json_data:
-        slice_timing = json_data['SliceTiming']
+        # Copy so that the sidecar is not modified when reversing
+        slice_timing = list(json_data['SliceTiming'])
     else:
         raise RuntimeError("No tag SliceTiming to automatically parse slice data, see --slices option")
 
@@ -2252,8 +2256,8 @@ def extend_fmap_to_kernel_size(nii_fmap_orig, dilation_kernel_size, path_output=
     for i_axis in range(len(fieldmap_shape)):
         # If there are less voxels than the kernel size, extend in that axis
         if fieldmap_shape[i_axis] < dilation_kernel_size:
-            diff = float(dilation_kernel_size - fieldmap_shape[i_axis])
-            n_slices_to_extend = math.ceil(diff / 2)
+            # Slices are added on both sides, round up with integer math
+            n_slices_to_extend = (dilation_kernel_size - fieldmap_shape[i_axis] + 1) // 2
             tmp_nii = extend_slice(tmp_nii, n_slices=n_slices_to_extend, axis=i_axis)
 
     nii_fmap = tmp_nii
@@ -2285,11 +2289,12 @@ def extend_slice(nii_array, n_slices=1, axis=2):
             nii_out = extend_slice(nii_array, n_slices=1, axis=2)
             print(nii_out.get_fdata().shape)  # (50, 50, 3, 10)
     """
-    if nii_array.get_fdata().ndim == 3:
-        extended = nii_array.get_fdata()
-        extended = extended[..., np.newaxis]
-    elif nii_array.get_fdata().ndim == 4:
-        extended = nii_array.get_fdata()
+    # Read the data once, in the data type of the image, to avoid a float64 copy
+    data = np.asanyarray(nii_array.dataobj)
+    if data.ndim == 3:
+        extended = data[..., np.newaxis]
+    elif data.ndim == 4:
+        extended = data
     else:
         raise ValueError("Unsupported number of dimensions for input array")
 
@@ -2308,7 +2313,7 @@ def extend_slice(nii_array, n_slices=1, axis=2):
 
     new_affine = update_affine_for_ap_slices(nii_array.affine, n_slices, axis)
 
-    if nii_array.get_fdata().ndim == 3:
+    if data.ndim == 3:
         extended = extended[..., 0]
 
     nii_extended = nib.Nifti1Image(extended, new_affine, header=nii_array.header)
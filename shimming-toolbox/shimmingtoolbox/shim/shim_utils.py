@@ -3,10 +3,12 @@
 This file includes utility functions useful for the shimming module
 """
 
+import functools
 import nibabel as nib
 import json
 import numpy as np
 import logging
+import os
 
 from shimmingtoolbox.coils.coil import SCANNER_CONSTRAINTS, SCANNER_CONSTRAINTS_DAC
 from shimmingtoolbox.coils.coordinates import phys_to_vox_coefs, get_main_orientation
@@ -34,6 +36,19 @@ def get_phase_encode_direction_sign(fname_nii):
     with open(fname_json) as json_file:
         json_data = json.load(json_file)
 
+    return _phase_encode_direction_is_positive(dim_info, json_data)
+
+
+def _phase_encode_direction_is_positive(dim_info, json_data):
+    """ Returns the phase encode direction sign from already loaded metadata
+
+    Args:
+        dim_info (tuple): Output of the ``get_dim_info()`` method of the NIfTI header (freq, phase, slice)
+        json_data (dict): BIDS sidecar of the NIfTI file
+
+    Returns:
+        bool: Returns whether the encoding direction is positive (True) or negative (False)
+    """
     # json_data['PhaseEncodingDirection'] contains i, j or k then a '-' if the direction is reversed
     phase_en_dir = json_data['PhaseEncodingDirection']
 
@@ -54,14 +69,19 @@ def get_phase_encode_direction_sign(fname_nii):
     return en_is_positive
 
 
-def phys_to_gradient_cs(coefs_x, coefs_y, coefs_z, fname_anat):
-    """ Converts physical coefficients (x, y, z from RAS Coordinate System) to Siemens Gradient Coordinate System
+def phys_to_gradient_cs(coefs_x, coefs_y, coefs_z, anat, json_anat=None):
+    """ Converts physical coefficients (x, y, z from RAS Coordinate System) to Siemens Gradient Coordinate System. The
+    coefficient arrays can have any shape as long as it is the same for x, y and z. This allows converting multiple sets
+    of coefficients (i.e. static and riro) with a single call.
 
     Args:
         coefs_x (numpy.ndarray): Array containing x coefficients in the physical coordinate system RAS
         coefs_y (numpy.ndarray): Array containing y coefficients in the physical coordinate system RAS
         coefs_z (numpy.ndarray): Array containing z coefficients in the physical coordinate system RAS
-        fname_anat (str): Filename of the NIfTI file to convert the data to that Gradient CS
+        anat (str, os.PathLike or nib.Nifti1Image): Filename of the NIfTI file to convert the data to that Gradient
+                                                    CS or its already loaded Nibabel object. If a Nibabel object is
+                                                    provided, ``json_anat`` must also be provided.
+        json_anat (dict): BIDS sidecar of the NIfTI file. If None, it is read from the disk next to ``anat``.
 
     Returns:
         (tuple): tuple containing:
@@ -71,7 +91,17 @@ def phys_to_gradient_cs(coefs_x, coefs_y, coefs_z, fname_anat):
 
     """
     # Load anat
-    nii_anat = nib.load(fname_anat)
+    if isinstance(anat, nib.Nifti1Image):
+        nii_anat = anat
+        if json_anat is None:
+            raise ValueError("The json sidecar must be provided when the anat is a Nibabel object")
+    else:
+        # Filename (str or path-like)
+        nii_anat = nib.load(anat)
+        if json_anat is None:
+            fname_anat_json = os.fspath(anat).rsplit('.nii', 1)[0] + '.json'
+            with open(fname_anat_json) as json_file:
+                json_anat = json.load(json_file)
 
     # Convert from patient coordinates to image coordinates
     scanner_coil_coef_vox = phys_to_vox_coefs(coefs_x, coefs_y, coefs_z, nii_anat.affine)
@@ -85,20 +115,15 @@ def phys_to_gradient_cs(coefs_x, coefs_y, coefs_z, fname_anat):
     # defined by the frequency, phase and slice encode directions.
     # TODO: More tests, validated for TRA, SAG, COR, no-flip/flipped PE, no rotation
 
-    # Load anat json
-    fname_anat_json = fname_anat.rsplit('.nii', 1)[0] + '.json'
-    with open(fname_anat_json) as json_file:
-        json_anat_data = json.load(json_file)
-
-    if 'ImageOrientationText' in json_anat_data:
+    if 'ImageOrientationText' in json_anat:
         # Tag in private dicom header (0051,100E) indicates the slice orientation, if it exists, it will appear
         # in the json under 'ImageOrientationText' tag
-        orientation_text = json_anat_data['ImageOrientationText']
+        orientation_text = json_anat['ImageOrientationText']
         orientation = orientation_text[:3].upper()
     else:
         # Find orientation with the ImageOrientationPatientDICOM tag, this is less reliable since it can fail
         # if there are 2 highest cosines. It will raise an exception if there is a problem
-        orientation = get_main_orientation(json_anat_data['ImageOrientationPatientDICOM'])
+        orientation = get_main_orientation(json_anat['ImageOrientationPatientDICOM'])
 
     if orientation == 'SAG':
         coefs_slice = -coefs_slice
@@ -108,7 +133,7 @@ def phys_to_gradient_cs(coefs_x, coefs_y, coefs_z, fname_anat):
         # TRA
         pass
 
-    phase_encode_is_positive = get_phase_encode_direction_sign(fname_anat)
+    phase_encode_is_positive = _phase_encode_direction_is_positive(dim_info, json_anat)
     if not phase_encode_is_positive:
         coefs_freq = -coefs_freq
         coefs_phase = -coefs_phase
@@ -161,7 +186,8 @@ def phys_to_shim_cs(coefs, manufacturer, orders):
         coefs (np.ndarray): Coefficients in the physical RAS coordinate system of the manufacturer. The first
                             dimension represents the different channels. (indexes 0, 1, 2 --> x, y, z...). If there are
                             more coefficients, they are of higher order and must correspond to the implementation of the
-                            manufacturer. i.e. Siemens: *X, Y, Z, Z2, ZX, ZY, X2-Y2, XY*
+                            manufacturer. i.e. Siemens: *X, Y, Z, Z2, ZX, ZY, X2-Y2, XY*. Additional dimensions (i.e.
+                            different shims) are converted all at once.
         manufacturer (str): Name of the manufacturer
         orders (tuple): Tuple containing the spherical harmonic orders
 
@@ -175,7 +201,8 @@ def phys_to_shim_cs(coefs, manufacturer, orders):
         if len(flip_mat) != len(coefs):
             logger.warning("Could not convert between shim and physical coordinate system")
         else:
-            coefs = flip_mat * coefs
+            # Flip along the first dimension (channels)
+            coefs = np.reshape(flip_mat, (-1,) + (1,) * (np.ndim(coefs) - 1)) * coefs
 
     else:
         logger.warning(f"Manufacturer: {manufacturer} not implemented for the Shim CS. Coefficients might be wrong.")
@@ -187,10 +214,11 @@ def shim_to_phys_cs(coefs, manufacturer, orders):
     """ Convert coefficients from the shim coordinate system to the physical RAS coordinate system
 
     Args:
-        coefs (np.ndarray): 1D list of coefficients in the Shim Coordinate System of the manufacturer. The first
+        coefs (np.ndarray): Coefficients in the Shim Coordinate System of the manufacturer. The first
                             dimension represents the different channels. Indexes 0, 1, 2 --> x, y, z... If there are
                             more coefficients, they are of higher order and must correspond to the implementation of the
-                            manufacturer. Siemens: *X, Y, Z, Z2, ZX, ZY, X2-Y2, XY*
+                            manufacturer. Siemens: *X, Y, Z, Z2, ZX, ZY, X2-Y2, XY*. Additional dimensions (i.e.
+                            different shims) are converted all at once.
         manufacturer (str): Name of the manufacturer
         orders (tuple): Tuple containing the spherical harmonic orders
 
@@ -235,14 +263,15 @@ def get_scanner_shim_settings(bids_json_dict, orders):
 
     # get_shim_orders
     if bids_json_dict.get('ShimSetting'):
-        n_shim_values = len(bids_json_dict.get('ShimSetting'))
+        # Copy so that the BIDS sidecar dictionary is never modified through the returned settings
+        shim_setting = list(bids_json_dict['ShimSetting'])
+        n_shim_values = len(shim_setting)
         if n_shim_values == 3:
-            scanner_shim['1'] = bids_json_dict.get('ShimSetting')
+            scanner_shim['1'] = shim_setting
             scanner_shim['order1_is_valid'] = True
         elif n_shim_values == 8:
-            pass
-            scanner_shim['2'] = bids_json_dict.get('ShimSetting')[3:]
-            scanner_shim['1'] = bids_json_dict.get('ShimSetting')[:3]
+            scanner_shim['2'] = shim_setting[3:]
+            scanner_shim['1'] = shim_setting[:3]
             scanner_shim['order1_is_valid'] = True
             scanner_shim['order2_is_valid'] = True
         else:
@@ -272,10 +301,11 @@ def dac_to_shim_units(manufacturer, manufacturers_model_name, shim_settings):
                        a list of 5 coefficients. 'orderX_is_valid' is a boolean.
 
     Returns:
-        dict: Same dictionary as the shim_settings input with coefficients of the first, second and third order
-              converted according to the appropriate manufacturer model.
+        dict: Copy of the shim_settings input with coefficients of the first, second and third order converted
+              according to the appropriate manufacturer model. The input is not modified.
     """
-    scanner_shim_mp = shim_settings
+    # Shallow copy, the converted orders are replaced and not modified in place
+    scanner_shim_mp = dict(shim_settings)
 
     # Check if the manufacturer is implemented
     if manufacturer not in SCANNER_CONSTRAINTS_DAC.keys():
@@ -307,9 +337,8 @@ def dac_to_shim_units(manufacturer, manufacturers_model_name, shim_settings):
                     continue
 
                 # Convert the shim settings to ui units
-                scanner_shim_mp[order] = _convert_to_ui_units(shim_settings[order],
-                                                              scanner_constraints[order],
-                                                              scanner_constraints_dac[order])
+                scanner_shim_mp[order] = _convert_to_ui_units(shim_settings[order], manufacturer,
+                                                              manufacturers_model_name, order)
 
     else:
         logger.warning(f"Manufacturer model {manufacturers_model_name} not implemented,"
@@ -318,12 +347,38 @@ def dac_to_shim_units(manufacturer, manufacturers_model_name, shim_settings):
     return scanner_shim_mp
 
 
-def _convert_to_ui_units(shim_settings_coefs, scanner_constraints, scanner_constraints_dac):
-    # Convert to ui units
-    coefs_dac = shim_settings_coefs
-    max_coef_ui = np.array([cst[1] for cst in scanner_constraints])
+@functools.lru_cache(maxsize=None)
+def _get_ui_conversion_factors(manufacturer, manufacturers_model_name, order):
+    """ Returns the factors to convert the shim settings of an order from DAC to ui units as well as the min and max
+        ui values. The arrays are shared between calls and are therefore read only.
+
+    Args:
+        manufacturer (str): Manufacturer of the scanner.
+        manufacturers_model_name (str): Name of the model of the scanner.
+        order (str): Spherical harmonic order.
+
+    Returns:
+        (tuple): tuple containing:
+
+            * np.ndarray: Factors to multiply the DAC values with to obtain ui units.
+            * np.ndarray: Minimum ui value of each channel.
+            * np.ndarray: Maximum ui value of each channel.
+    """
+    scanner_constraints = SCANNER_CONSTRAINTS[manufacturer][manufacturers_model_name][order]
+    scanner_constraints_dac = SCANNER_CONSTRAINTS_DAC[manufacturer][manufacturers_model_name][order]
     min_coef_ui = np.array([cst[0] for cst in scanner_constraints])
-    coefs_ui = (np.array(coefs_dac) * max_coef_ui / np.array(scanner_constraints_dac))
+    max_coef_ui = np.array([cst[1] for cst in scanner_constraints])
+    factors = max_coef_ui / np.array(scanner_constraints_dac)
+    for array in (factors, min_coef_ui, max_coef_ui):
+        array.setflags(write=False)
+
+    return factors, min_coef_ui, max_coef_ui
+
+
+def _convert_to_ui_units(shim_settings_coefs, manufacturer, manufacturers_model_name, order):
+    # Convert to ui units
+    factors, min_coef_ui, max_coef_ui = _get_ui_conversion_factors(manufacturer, manufacturers_model_name, order)
+    coefs_ui = np.asarray(shim_settings_coefs) * factors
     tolerance = 0.001 * max_coef_ui
     if np.any(coefs_ui > (max_coef_ui + tolerance)) or np.any(coefs_ui < (min_coef_ui - tolerance)):
         raise ValueError("Current shim settings exceed known system limits.")
@@ -347,10 +402,10 @@ class ScannerShimSettings:
                 if self.shim_settings.get(str(order)) is not None:
                     if not self.shim_settings[f'order{order}_is_valid']:
                         raise ValueError(f"Order {order} shim settings is not valid")
-                    # Concatenate 2 lists
-                    coefs.extend(self.shim_settings.get(str(order)))
+                    coefs.append(np.asarray(self.shim_settings.get(str(order)), dtype=np.float64))
                 else:
                     n_coefs = channels_per_order(order)
-                    coefs.extend([0] * n_coefs)
+                    coefs.append(np.zeros(n_coefs))
 
-        return coefs
+        # Single contiguous array so that it can be broadcast against the coefficients
+        return np.concatenate(coefs) if coefs else np.zeros(0)
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*
 
 import copy
+import logging
 import pytest
 from click.testing import CliRunner
 import tempfile
@@ -13,11 +14,13 @@ import json
 
 from shimmingtoolbox import __config_custom_coil_constraints__
 from shimmingtoolbox.cli.b0shim import define_slices_cli
-from shimmingtoolbox.cli.b0shim import b0shim_cli
+from shimmingtoolbox.cli import b0shim
+from shimmingtoolbox.cli.b0shim import b0shim_cli, _get_fname_json, _get_slice_to_shim, _read_json
 from shimmingtoolbox.masking.shapes import shapes
 from shimmingtoolbox import __dir_testing__
 from shimmingtoolbox.coils.spher_harm_basis import siemens_basis
 from shimmingtoolbox.coils.coordinates import generate_meshgrid
+from shimmingtoolbox.shim.shim_utils import ScannerShimSettings
 
 
 def _define_inputs(fmap_dim, manufacturers_model_name=None, no_shim_settings=False):
@@ -1027,6 +1030,64 @@ class TestCLIRealtime(object):
             assert os.path.isfile(os.path.join(tmp, "coefs_coil0_ch2_Prisma_fit.txt"))
             assert os.path.isfile(os.path.join(tmp, "coefs_coil0_ch3_Prisma_fit.txt"))
 
+    def test_cli_rt_absolute_values(self, nii_fmap, nii_anat, nii_mask, fm_data, anat_data, caplog):
+        with tempfile.TemporaryDirectory(prefix='st_' + pathlib.Path(__file__).stem) as tmp:
+            # Save the inputs to the new directory
+            fname_fmap = os.path.join(tmp, 'fmap.nii.gz')
+            fname_fm_json = os.path.join(tmp, 'fmap.json')
+            fname_mask = os.path.join(tmp, 'mask.nii.gz')
+            fname_anat = os.path.join(tmp, 'anat.nii.gz')
+            fname_anat_json = os.path.join(tmp, 'anat.json')
+            _save_inputs(nii_fmap=nii_fmap, fname_fmap=fname_fmap,
+                         nii_anat=nii_anat, fname_anat=fname_anat,
+                         nii_mask=nii_mask, fname_mask=fname_mask,
+                         fm_data=fm_data, fname_fm_json=fname_fm_json,
+                         anat_data=anat_data, fname_anat_json=fname_anat_json)
+
+            # Input pmu fname
+            fname_resp = os.path.join(__dir_testing__, 'ds_b0', 'derivatives', 'sub-realtime',
+                                      'sub-realtime_PMUresp_signal.resp')
+
+            # Run the same shim with the delta and absolute output formats
+            static_coefs = {}
+            for output_value_format in ['delta', 'absolute']:
+                path_output = os.path.join(tmp, output_value_format)
+                caplog.clear()
+                with caplog.at_level(logging.INFO):
+                    runner = CliRunner()
+                    res = runner.invoke(b0shim_cli, ['realtime-dynamic',
+                                                     '--fmap', fname_fmap,
+                                                     '--anat', fname_anat,
+                                                     '--mask-static', fname_mask,
+                                                     '--mask-riro', fname_mask,
+                                                     '--resp', fname_resp,
+                                                     '--slice-factor', '2',
+                                                     '--scanner-coil-order', '0,1',
+                                                     '--fatsat', 'no',
+                                                     '--output-value-format', output_value_format,
+                                                     '--output', path_output],
+                                        catch_exceptions=False)
+                assert res.exit_code == 0
+
+                # Each coil file is listed once
+                message = [record.getMessage() for record in caplog.records
+                           if record.getMessage().startswith("Coil txt file(s) are here:")][0]
+                list_fname_output = message.splitlines()[1:]
+                assert len(list_fname_output) == len(set(list_fname_output)) == 4
+
+                static_coefs[output_value_format] = []
+                for i_channel in range(4):
+                    fname = os.path.join(path_output, f"coefs_coil0_ch{i_channel}_Prisma_fit.txt")
+                    assert os.path.abspath(fname) in list_fname_output
+                    # The static coefficient is the first value of each row
+                    static_coefs[output_value_format].append(np.loadtxt(fname, delimiter=',', usecols=0))
+
+            # abs_coef = delta + initial
+            initial_coefs = ScannerShimSettings(fm_data, orders=[0, 1]).concatenate_shim_settings([0, 1])
+            for i_channel in range(4):
+                assert np.allclose(static_coefs['absolute'][i_channel],
+                                   static_coefs['delta'][i_channel] + initial_coefs[i_channel], rtol=0, atol=1e-5)
+
     def test_cli_rt_pseudo_inverse(self, nii_fmap, nii_anat, nii_mask, fm_data, anat_data):
         with tempfile.TemporaryDirectory(prefix='st_' + pathlib.Path(__file__).stem) as tmp:
             # Save the inputs to the new directory
@@ -1189,6 +1250,46 @@ def test_cli_define_slices_wrong_output():
                           catch_exceptions=False)
 
 
+def test_get_slice_to_shim():
+    list_slices = [(0, 2, 4), (1, 3, 5)]
+    assert np.all(_get_slice_to_shim(list_slices) == [0, 1, 0, 1, 0, 1])
+
+
+def test_get_slice_to_shim_missing_slice():
+    with pytest.raises(ValueError, match="Some slices are not part of a shim group"):
+        _get_slice_to_shim([(0, 1), (1, 2)])
+
+
+@pytest.mark.parametrize(
+    "fname_nii,fname_json", [
+        ('/data/fmap.nii.gz', '/data/fmap.json'),
+        ('/data/fmap.nii', '/data/fmap.json'),
+        ('/data.nii_backup/fmap.nii.gz', '/data.nii_backup/fmap.json'),
+    ]
+)
+def test_get_fname_json(fname_nii, fname_json):
+    assert _get_fname_json(fname_nii) == fname_json
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_read_json_nan(use_orjson, monkeypatch):
+    if not use_orjson:
+        monkeypatch.setattr(b0shim, 'orjson', None)
+
+    with tempfile.TemporaryDirectory(prefix='st_' + pathlib.Path(__file__).stem) as tmp:
+        # NaN is not valid json but it is accepted by the json module and can appear in sidecars
+        fname_json = os.path.join(tmp, 'sidecar.json')
+        with open(fname_json, 'w') as f:
+            f.write('{"EchoTime": 0.0025, "ShimSetting": [1, 2, 3], "SliceTiming": NaN, "Manufacturer": "Siemens"}')
+
+        data = _read_json(fname_json)
+        with open(fname_json) as f:
+            expected = json.load(f)
+
+    assert np.isnan(data.pop('SliceTiming')) and np.isnan(expected.pop('SliceTiming'))
+    assert data == expected
+
+
 def _save_inputs(nii_fmap=None, fname_fmap=None,
                  nii_anat=None, fname_anat=None,
                  nii_mask=None, fname_mask=None,
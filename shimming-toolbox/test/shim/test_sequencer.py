@@ -743,6 +743,11 @@ class TestExtendSlice(object):
 
         assert nii_out.get_fdata().shape == (2, 8, 5, 5)
 
+    def test_extend_slice_keeps_dtype(self, nii_4d):
+        nii_out = extend_slice(nii_4d[0], 1, 2)
+
+        assert np.asanyarray(nii_out.dataobj).dtype == np.uint8
+
     def test_extend_slice_wrong_dim(self, nii_4d):
         nii_2d = nib.Nifti1Image(nii_4d[0].get_fdata()[..., 0, 0], nii_4d[0].affine)
         with pytest.raises(ValueError, match="Unsupported number of dimensions for input array"):
@@ -1,11 +1,17 @@
 #!usr/bin/env python3
 # -*- coding: utf-8
 
+import json
 import logging
+import nibabel as nib
 import numpy as np
+import os
+import pathlib
 import pytest
 
-from shimmingtoolbox.shim.shim_utils import dac_to_shim_units, phys_to_shim_cs, shim_to_phys_cs, logger
+from shimmingtoolbox import __dir_testing__
+from shimmingtoolbox.shim.shim_utils import dac_to_shim_units, phys_to_gradient_cs, phys_to_shim_cs, shim_to_phys_cs
+from shimmingtoolbox.shim.shim_utils import logger
 
 
 class TestDacToShimUnits:
@@ -38,6 +44,12 @@ class TestDacToShimUnits:
         assert np.all(np.isclose(ui_units['1'], [0, 0, 0]))
         assert np.all(np.isclose(ui_units['2'], [0, 0, 0, 0, 0]))
 
+    def test_dac_to_shim_units_input_not_modified(self):
+        dac_units = {'1': [14436, 14265, 14045], '2': [9998, 9998, 9998, 9998, 9998],
+                     'order1_is_valid': True, 'order2_is_valid': True}
+        dac_to_shim_units('Siemens', 'Prisma_fit', dac_units)
+        assert dac_units['1'] == [14436, 14265, 14045]
+
     def test_dac_to_shim_units_unknown_scanner(self, caplog):
         dac_units = {'1': [14436, 14265, 14045], '2': [9998, 9998, 9998, 9998, 9998],
                      'order1_is_valid': True, 'order2_is_valid': True}
@@ -63,3 +75,30 @@ def test_phys_to_shim_cs():
 def test_shim_to_phys_cs():
     out = shim_to_phys_cs(np.array([1, 1, 1]), 'Siemens', orders=(1,))
     assert np.all(out == [-1, 1, -1])
+
+
+def test_shim_to_phys_cs_2d():
+    out = shim_to_phys_cs(np.array([[1, 2], [1, 2], [1, 2]]), 'Siemens', orders=(1,))
+    assert np.all(out == [[-1, -2], [1, 2], [-1, -2]])
+
+
+def test_phys_to_gradient_cs_inputs():
+    fname_anat = os.path.join(__dir_testing__, 'ds_b0', 'sub-realtime', 'anat', 'sub-realtime_unshimmed_e1.nii.gz')
+    with open(os.path.join(__dir_testing__, 'ds_b0', 'sub-realtime', 'anat', 'sub-realtime_unshimmed_e1.json')) as f:
+        json_anat = json.load(f)
+    coefs_x = np.array([1.0, 2.0])
+    coefs_y = np.array([3.0, 4.0])
+    coefs_z = np.array([5.0, 6.0])
+
+    out_fname = phys_to_gradient_cs(coefs_x, coefs_y, coefs_z, fname_anat)
+    out_path = phys_to_gradient_cs(coefs_x, coefs_y, coefs_z, pathlib.Path(fname_anat))
+    out_nii = phys_to_gradient_cs(coefs_x, coefs_y, coefs_z, nib.load(fname_anat), json_anat)
+
+    assert np.allclose(out_path, out_fname)
+    assert np.allclose(out_nii, out_fname)
+
+
+def test_phys_to_gradient_cs_nii_without_json():
+    fname_anat = os.path.join(__dir_testing__, 'ds_b0', 'sub-realtime', 'anat', 'sub-realtime_unshimmed_e1.nii.gz')
+    with pytest.raises(ValueError, match="The json sidecar must be provided"):
+        phys_to_gradient_cs(np.array([1.0]), np.array([1.0]), np.array([1.0]), nib.load(fname_anat))